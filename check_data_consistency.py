@@ -1,37 +1,73 @@
 #!/usr/bin/env python
 
 import os
+import array
+import itertools
+import sqlite3
+try:
+    import numpy as np
+except ImportError: # numpy is optional; only speeds up the check on SQLite without LAG()
+    np = None
 from ohlcv_aggregator import OHLCVAggregator
 from whitelist import whitelist
 
+# LAG() and other window functions are available since SQLite 3.25.0
+HAS_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)
+
 def get_all_unix_ms(cursor, table_name):
-    """Gets the latest recorded unix_ms timestamp from specified table."""
+    """Gets all recorded unix_ms timestamps from specified table as a contiguous int64 array."""
+    sql = "SELECT unix_ms_close FROM `{}` ORDER BY unix_ms_close ASC".format(table_name)
+    cursor.execute(sql)
+    all_unix_ms = array.array('q')
+    all_unix_ms.extend(unix_ms for (unix_ms,) in cursor)
+    return all_unix_ms
+
+def get_inconsistent_period(all_unix_ms, period_ms):
+    """Gets the first period between adjacent timestamps that differs from expected one, if any."""
+    if np is not None:
+        # view the array buffer without copying and diff it in C
+        periods_ms = np.diff(np.frombuffer(all_unix_ms, dtype=np.int64))
+        inconsistent_idx = np.flatnonzero(periods_ms != period_ms)
+        if inconsistent_idx.size:
+            return int(periods_ms[inconsistent_idx[0]])
+        return None
+    # islice avoids copying the array, which slicing would do
+    for prev_unix_ms, unix_ms in zip(all_unix_ms, itertools.islice(all_unix_ms, 1, None)):
+        if unix_ms - prev_unix_ms != period_ms:
+            return unix_ms - prev_unix_ms
+
+def get_inconsistent_period_sql(cursor, period_ms, table_name):
+    """Gets the first period between adjacent records that differs from expected one, if any."""
+    # let SQLite compute deltas between adjacent records and return only the offending ones
+    sql = """SELECT unix_ms_close, delta_ms FROM (
+        SELECT unix_ms_close, unix_ms_close - LAG(unix_ms_close) OVER (ORDER BY unix_ms_close) AS delta_ms
+        FROM `{}`) WHERE delta_ms IS NOT NULL AND delta_ms != ? LIMIT 1""".format(table_name)
+    cursor.execute(sql, (period_ms,))
+    inconsistency = cursor.fetchone()
+    if inconsistency is not None:
+        return inconsistency[1]
+
+def check_period(cursor, period_ms, table_name):
+    """Checks if adjacent OHLCV records in a table have expected period."""
     try:
-        sql = "SELECT unix_ms_close FROM `{}` ORDER BY unix_ms_close ASC".format(table_name)
-        cursor.execute(sql)
-        result = cursor.fetchall()
-        all_unix = [x[0] for x in result]
-        return all_unix
+        if HAS_WINDOW_FUNCTIONS:
+            inconsistent_period_ms = get_inconsistent_period_sql(cursor, period_ms, table_name)
+        else:
+            all_unix_ms = get_all_unix_ms(cursor, table_name)
+            inconsistent_period_ms = get_inconsistent_period(all_unix_ms, period_ms)
+        if inconsistent_period_ms is not None:
+            print('Inconsistency in {}. At least two adjacent OHLCV records have period of {} ms'.format(table_name, inconsistent_period_ms))
+            return
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM `{}`)".format(table_name))
+        if not cursor.fetchone()[0]:
+            print('No records found in table {}'.format(table_name))
     except Exception as e:
         print(str(e))
 
-def check_period(all_unix_ms, period_ms, table_name):
-    """Checks if adjacent OHLCV records in a table have expected period."""
-    if all_unix_ms:
-        prev_unix_ms = all_unix_ms[0] - period_ms
-        for unix_ms in all_unix_ms:
-            if unix_ms - prev_unix_ms != period_ms:
-                print('Inconsistency in {}. At least two adjacent OHLCV records have period of {} ms'.format(table_name, unix_ms-prev_unix_ms))
-                break
-            prev_unix_ms = unix_ms
-    else:
-        print('No records found in table {}'.format(table_name))
-
 def check_data_consistency(cursor, table_names, period_ms):
     """Checks every table in db for unix_ms period consistency between adjacent OHLCV records."""
     for table_name in table_names:
-        all_unix_ms = get_all_unix_ms(cursor, table_name)
-        check_period(all_unix_ms, period_ms, table_name)
+        check_period(cursor, period_ms, table_name)
 
 def main():
     wl = whitelist
@@ -1,18 +1,38 @@
 #!/usr/bin/env python
 
 import os
+import time
+import asyncio
 import sqlite3
 import logging
 import ccxt
+import ccxt.async_support as ccxt_async
 from whitelist import whitelist
 
+# max rows per multi-row INSERT; default SQLITE_MAX_VARIABLE_NUMBER (999) / 6 columns
+MAX_ROWS_PER_INSERT = 999 // 6
+# WITHOUT ROWID tables are available since SQLite 3.8.2, STRICT tables since 3.37.0
+TABLE_OPTIONS = []
+if sqlite3.sqlite_version_info >= (3, 8, 2):
+    TABLE_OPTIONS.append('WITHOUT ROWID')
+if sqlite3.sqlite_version_info >= (3, 37, 0):
+    TABLE_OPTIONS.append('STRICT')
+# errors that only skip the pair being fetched
+# (NotSupported, AuthenticationError etc. subclass ExchangeError; DDoSProtection, RequestTimeout,
+# ExchangeNotAvailable subclass NetworkError, which ccxt also raises on its own for connection failures)
+CCXT_ERRORS = (ccxt.errors.ExchangeError, ccxt.errors.NetworkError)
+# markets are reloaded only once they are older than this
+MARKETS_TTL_SEC = 3600
+
 
 class OHLCVAggregator(object):
 
     """Creates a db containing separate tables with OHLCV data for select pairs using ccxt lib.
 
     To aggregate OHLCV data using ccxt library with no breaks, it's sufficient to initialize
-    this class and periodically call update_ohlcv() method. The period with which the method
+    this class and periodically run update_ohlcv() coroutine (e.g. asyncio.run(aggregator.update_ohlcv())),
+    which fetches all pairs concurrently. Exchange instances are created per update, so each run
+    may use its own event loop; only loaded markets are carried over between updates. The period with which the method
     should be called depends on how often you want to update the db with the latest info
     and the period of the OHLCV data that you are fetching. Elaborating on the latter:
     it looks like the some exchanges' API offers a very small number of OHLCV records at a time
@@ -22,12 +42,16 @@ class OHLCVAggregator(object):
 
     Attributes:
         db_path: A path that contains/will contain SQLite3 db.
-        connection: SQLite3 db connection; used for commiting INSERT transactions.
+        connection: SQLite3 db connection in autocommit mode; transactions are opened explicitly.
         cursor: SQLite db cursor; used for executing all SQL queries.
         period: An string that specifies desired OHLCV period.
         whitelist: A dict containing exchanges and their pairs that we want to fetch.
         table_names: A set of all asset pairs that the aggregator is tracking.
                     Corresponds to table names used in the db.
+        insert_sql: A dict mapping (table name, number of rows) to a multi-row INSERT query.
+                    Reusing the same query strings lets sqlite3 reuse their cached prepared statements.
+        markets: A dict mapping exchange names to (markets, currencies) from their last markets load.
+        markets_ts: A dict mapping exchange names to the unix timestamp of their last markets load.
     """
 
     def __init__(self, db_path, period, whitelist):
@@ -44,11 +68,23 @@ class OHLCVAggregator(object):
         self.period = period
         self.whitelist = whitelist
         self.table_names = self.__init_table_names()
+        self.insert_sql = {}
+        self.markets = {}
+        self.markets_ts = {}
 
     def __init_db(self):
         """Inits db connection and cursor."""
-        connection = sqlite3.connect(self.db_path)
+        # sqlite3 caches only 128 prepared statements by default; 1024 fits the INSERTs (full chunk and
+        # remainder) of ~500 tables, with all-market exchanges whitelisted the rest get re-prepared
+        # isolation_level=None disables implicit transactions, so only explicit BEGIN/COMMIT count
+        connection = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=1024)
         cursor = connection.cursor()
+        # WAL with synchronous=NORMAL is safe for append-only data and saves fsyncs on commit
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-65536') # 64 MiB page cache
+        cursor.execute('PRAGMA mmap_size=268435456') # 256 MiB
         return connection, cursor
 
     def __init_table_names(self):
@@ -58,6 +94,18 @@ class OHLCVAggregator(object):
         table_names = set([x[0] for x in result])
         return table_names
 
+    def __create_whitelisted_tables(self):
+        """Creates tables for all explicitly whitelisted pairs in one transaction."""
+        table_names = [OHLCVAggregator.__create_table_name(exchange_name, pair)
+                       for exchange_name, pairs in self.whitelist['exchanges'].items()
+                       for pair in pairs]
+        table_names = [table_name for table_name in table_names if table_name not in self.table_names]
+        if not table_names:
+            return # don't take the write lock when there's nothing to create
+        self.cursor.execute('BEGIN IMMEDIATE')
+        self.__create_tables(table_names)
+        self.cursor.execute('COMMIT')
+
     @staticmethod
     def __create_table_name(exchange_name, pair_name):
         """Create a table name to be inserted to the db"""
@@ -67,101 +115,148 @@ class OHLCVAggregator(object):
         return table_name
 
     def __create_table(self, table_name):
-        """ Creates new table to hold OHLC data."""
+        """ Creates new table to hold OHLC data. Returns True if the table was created."""
         try:
-            self.cursor.execute("""CREATE TABLE IF NOT EXISTS `{}` (unix_ms_close INT PRIMARY KEY,
-                open REAL, high REAL, low REAL, close REAL, volume REAL)""".format(table_name))
+            # WITHOUT ROWID stores rows in the primary key b-tree itself, without a separate rowid
+            self.cursor.execute("""CREATE TABLE IF NOT EXISTS `{}` (unix_ms_close INTEGER PRIMARY KEY,
+                open REAL, high REAL, low REAL, close REAL, volume REAL)
+                {}""".format(table_name, ', '.join(TABLE_OPTIONS)))
+            return True
         except Exception as e:
             print(str(e))
+            return False
 
-    def __get_latest_unix_ms(self, table_name):
-        """Gets the latest recorded unix_ms timestamp from specified table."""
-        try:
-            sql = "SELECT unix_ms_close FROM `{}` ORDER BY unix_ms_close DESC LIMIT 1".format(table_name)
-            self.cursor.execute(sql)
-            result = self.cursor.fetchone()
-            if result != None:
-                return result[0]
-        except Exception as e:
-            print(str(e))
+    def __create_tables(self, table_names):
+        """ Creates tables for all unseen pairs."""
+        for table_name in table_names:
+            if table_name not in self.table_names and self.__create_table(table_name):
+                self.table_names.add(table_name)
 
-    @staticmethod
-    def __add_ohlcv_row_sql(table_name, ohlcv_row):
-        """ Add a single OHLC record to a selected table."""
-        unix_ms, open_, high, low, close, *volume = ohlcv_row
-        # in case base and quote volumes are given, disregard base
-        if len(volume) == 2:
-            volume, _ = volume
-        else:
-            volume = volume[0]
-        sql_query = """INSERT INTO `{}` (unix_ms_close, open, high, low, close, volume)
-            VALUES (?,?,?,?,?,?);""".format(table_name)
-        sql_args = (unix_ms, open_, high, low, close, volume)
-        return (sql_query, sql_args)
+    def __get_insert_sql(self, table_name, n_rows):
+        """Gets a (cached) multi-row INSERT query for a table."""
+        key = (table_name, n_rows)
+        if key not in self.insert_sql:
+            values = ','.join(['(?,?,?,?,?,?)'] * n_rows)
+            self.insert_sql[key] = """INSERT OR IGNORE INTO `{}` (unix_ms_close, open, high, low, close, volume)
+                VALUES {};""".format(table_name, values)
+        return self.insert_sql[key]
 
     def __insert_tx(self, table_name, ohlcv_data):
-        """ Insert all unseen OHLC records to a table in one transaction."""
-        latest_unix_ms = self.__get_latest_unix_ms(table_name)
-        # case when table is empty
-        if not latest_unix_ms:
-            latest_unix_ms = 0
-        sql_tx = []
-        for ohlcv_row in ohlcv_data:
-            unix_ms = ohlcv_row[0]
-            # add fresh data only
-            if unix_ms > latest_unix_ms:
-                sql = OHLCVAggregator.__add_ohlcv_row_sql(table_name, ohlcv_row)
-                sql_tx.append(sql)
-        self.cursor.execute('BEGIN TRANSACTION')
-        for sql_query, sql_args in sql_tx:
-            try:
-                self.cursor.execute(sql_query, sql_args)
-            except:
-                pass
-        self.connection.commit()
+        """ Insert all unseen OHLC records to a table as part of the ongoing transaction.
+
+        Already stored records are skipped by INSERT OR IGNORE on the unix_ms_close primary key.
+        """
+        # insert in ascending unix_ms order, so rows are appended to the right edge of the PK b-tree
+        ohlcv_data = sorted(ohlcv_data, key=lambda ohlcv_row: ohlcv_row[0])
+        # in case two volumes are given, slicing keeps the first one, same as with a single volume
+        rows = [ohlcv_row[:6] for ohlcv_row in ohlcv_data]
+        # insert in chunks of multi-row VALUES to avoid per-row statement dispatch
+        for i in range(0, len(rows), MAX_ROWS_PER_INSERT):
+            chunk = rows[i:i + MAX_ROWS_PER_INSERT]
+            sql_args = [arg for row in chunk for arg in row]
+            self.cursor.execute(self.__get_insert_sql(table_name, len(chunk)), sql_args)
 
-    def update_ohlcv(self):
+    async def update_ohlcv(self):
         """Updates the db with the latest OHLC data from whitelisted exchanges"""
         exchange_names = self.whitelist['exchanges'].keys()
-        for exchange_name in exchange_names:
-            exchange = getattr(ccxt, exchange_name)()
+        # done here rather than in __init__, so that read-only users of the class don't create tables
+        self.__create_whitelisted_tables()
+        queue = asyncio.Queue()
+        # a single writer owns the db, fetchers only push (table_name, ohlcv_data) to the queue
+        writer = asyncio.ensure_future(self.__write_ohlcv(queue))
+        try:
+            # an exchange that fails unexpectedly must not cancel the others
+            results = await asyncio.gather(*[self.__fetch_exchange(exchange_name, queue)
+                                             for exchange_name in exchange_names],
+                                           return_exceptions=True)
+            for exchange_name, result in zip(exchange_names, results):
+                if isinstance(result, Exception):
+                    self.logger.error('%s update failed: %s', exchange_name, result, exc_info = result)
+        finally:
+            await queue.put(None) # signal the writer that fetching is done
+            await writer
+
+    async def __write_ohlcv(self, queue):
+        """Inserts fetched OHLC data to the db until a None sentinel is received."""
+        done = False
+        while not done:
+            # wait for data without holding the write lock, then take everything that's queued
+            items = [await queue.get()]
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            batch = [item for item in items if item is not None]
+            done = len(batch) < len(items)
+            if batch:
+                self.__insert_batch(batch)
+
+    def __insert_batch(self, batch):
+        """Inserts a batch of (table_name, ohlcv_data) items in one transaction."""
+        # there are no awaits in here, so the lock is never held while waiting on the network
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for table_name, ohlcv_data in batch:
+                # a failing pair must not stop the writer, otherwise the rest of the queue is lost
+                try:
+                    # pairs of all-market exchanges get their table once their first fetch succeeds
+                    self.__create_tables([table_name])
+                    self.__insert_tx(table_name, ohlcv_data)
+                except Exception as e:
+                    self.logger.error('Inserting into %s failed: %s', table_name, e, exc_info = True)
+        finally:
+            self.cursor.execute('COMMIT')
+
+    async def __fetch_exchange(self, exchange_name, queue):
+        """Fetches the latest OHLC data for every pair of an exchange concurrently."""
+        # ccxt async instances bind to the running loop, so a fresh one is used for every update;
+        # ccxt paces the requests made through a single exchange instance
+        exchange = getattr(ccxt_async, exchange_name)({'enableRateLimit': True})
+        try:
             try:
-                markets = exchange.load_markets()
+                markets = await self.__get_markets(exchange_name, exchange)
             except Exception as e:
                 self.logger.error(e, exc_info = True)
-                continue # don't proceed if loading market isn't working
+                return # don't proceed if loading market isn't working
             pairs = self.whitelist['exchanges'][exchange_name]
             # if no particular pairs are whitelisted, fetch all pairs from market
             if not pairs:
                 pairs = markets.keys()
-            for pair in pairs:
-                try:
-                    # try fetching ohlcv data... proceed with other stuff only if this succeeds
-                    ohlcv_data = exchange.fetch_ohlcv(pair, self.period)
-                    table_name = OHLCVAggregator.__create_table_name(exchange_name, pair)
-                    if table_name not in self.table_names:
-                        self.__create_table(table_name) # create table for unseen pair if needed
-                        self.table_names.add(table_name)
-                    self.__insert_tx(table_name, ohlcv_data)
-                except ccxt.errors.NotSupported as e:
-                    self.logger.info(e, exc_info = True)
-                except ccxt.errors.AuthenticationError as e:
-                    self.logger.info(e, exc_info = True)
-                except ccxt.errors.DDoSProtection as e:
-                    self.logger.error(e, exc_info = True)
-                except ccxt.errors.RequestTimeout as e:
-                    self.logger.error(e, exc_info = True)
-                except ccxt.errors.ExchangeNotAvailable as e:
-                    self.logger.error(e, exc_info = True)
-                except ccxt.errors.ExchangeError as e:
-                    self.logger.error(e, exc_info = True)
+            await asyncio.gather(*[self.__fetch_pair(exchange, exchange_name, pair, queue)
+                                   for pair in pairs])
+        finally:
+            await exchange.close()
+
+    async def __get_markets(self, exchange_name, exchange):
+        """Gets exchange markets, reloading them only if they are older than MARKETS_TTL_SEC."""
+        now = time.time()
+        if now - self.markets_ts.get(exchange_name, 0) > MARKETS_TTL_SEC:
+            markets = await exchange.load_markets(reload=True)
+            self.markets[exchange_name] = (markets, exchange.currencies)
+            self.markets_ts[exchange_name] = now
+            return markets
+        # hand the cached markets to the new instance instead of loading them over the network
+        markets, currencies = self.markets[exchange_name]
+        exchange.set_markets(markets, currencies)
+        return markets
+
+    async def __fetch_pair(self, exchange, exchange_name, pair, queue):
+        """Fetches the latest OHLC data for a single pair and queues it for insertion."""
+        try:
+            # try fetching ohlcv data... proceed with other stuff only if this succeeds
+            ohlcv_data = await exchange.fetch_ohlcv(pair, self.period)
+            table_name = OHLCVAggregator.__create_table_name(exchange_name, pair)
+            await queue.put((table_name, ohlcv_data))
+        except CCXT_ERRORS as e:
+            self.logger.error('%s failed for %s: %s', exchange_name, pair, e)
+        except Exception as e:
+            # anything else is unexpected, but it still must not abort the other pairs' fetches
+            self.logger.error('%s failed for %s: %s', exchange_name, pair, e, exc_info = True)
 
 def main():
     wl = whitelist
     database_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'ohlcv.db'))
     aggregator = OHLCVAggregator(db_path=database_path, period='1m', whitelist=wl)
     aggregator.logger.info('Started reading database')
-    aggregator.update_ohlcv()
+    asyncio.run(aggregator.update_ohlcv())
     aggregator.logger.info('Finished updating records\n\n###############################################################\n')
 
 